@@ -21,7 +21,9 @@ import bpy
 from difflib import SequenceMatcher
 from math import sqrt
 from copy import copy
-from mathutils import Vector
+from time import perf_counter
+from mathutils import Vector, Matrix
+from bpy.app.handlers import persistent
 import json
 
 
@@ -96,17 +98,22 @@ def sort_fingers(hand_bone, forward_vec):
     return sorted_fingers
 
 
-def detect_structure(armature):
-    arma_structure = {'Spine': [], 'R_Arm': [], 'L_Arm': [], 'L_Leg': [], 'R_Leg': [], 'Neck': [], 'Head': []}
+def empty_arma_structure():
+    return {'Spine': [], 'R_Arm': [], 'L_Arm': [], 'L_Leg': [], 'R_Leg': [], 'Neck': [], 'Head': []}
+
+
+def detect_structure_steps(armature, arma_structure):
+    ''' fill arma_structure in place, yield bone name after each scanned bone - so modal can split the scan '''
     root_bone = find_real_root_bone(armature)
     if not root_bone:
-        return arma_structure
+        return
     arma_size = copy(armature.dimensions.x)
     triple_child_cnt = 0  # how many times we have bone with 3child (must by legs, then arms)
 
     def scan_child_rec(bone, chain_name): # current_structure_name - 'Head', 'Leg', 'Neck', etc
         nonlocal triple_child_cnt, arma_size #!
         arma_structure[chain_name].append(bone) #add last bone to chain
+        yield bone.name
         if not bone.children:
             return
         if len(bone.children) == 3: # leg split, or arm split or ...?
@@ -116,13 +123,15 @@ def detect_structure(armature):
                     # scan_child_rec(right, 'R_Leg')
                     R_Leg_chain_bones, child_depth = get_longest_chain(right)
                     arma_structure['R_Leg'] = R_Leg_chain_bones
+                    yield right.name
 
                     # scan_child_rec(left, 'L_Leg')
                     L_Leg_chain_bones, child_depth = get_longest_chain(left)
                     arma_structure['L_Leg'] = L_Leg_chain_bones
+                    yield left.name
 
                     triple_child_cnt += 1
-                    scan_child_rec(center, 'Spine')
+                    yield from scan_child_rec(center, 'Spine')
                 elif triple_child_cnt == 1:  # must be arms plus neck
                     up_vec = bone_center(arma_structure['Spine'][-1]) - bone_center(arma_structure['Spine'][0])
                     up_vec = up_vec.normalized()
@@ -140,6 +149,7 @@ def detect_structure(armature):
                             for i, finger in enumerate(sorted_fingers):  # finger has 3 bones
                                 arma_structure['R_Finger'+str(i+1)] = finger
                             break
+                    yield right.name
 
                     # scan_child_rec(left, 'L_Arm')
                     L_arm_chain_bones, child_depth = get_longest_chain(left) #with one finger..
@@ -152,9 +162,10 @@ def detect_structure(armature):
                             for i, finger in enumerate(sorted_fingers): #finger has 3 bones
                                 arma_structure['L_Finger'+str(i+1)] = finger
                             break
+                    yield left.name
 
                     triple_child_cnt += 1
-                    scan_child_rec(center, 'Neck')
+                    yield from scan_child_rec(center, 'Neck')
             else: #triple split does not look like legs, or arms. What now?
                 pass
 
@@ -165,26 +176,411 @@ def detect_structure(armature):
                         if 'head' in child.name.lower():
                             arma_structure['Head'] = [child]
                             return  # finish scan on head
-                        scan_child_rec(child, chain_name)  # go up spine
+                        yield from scan_child_rec(child, chain_name)  # go up spine
 
-    scan_child_rec(root_bone, 'Spine')
+    yield from scan_child_rec(root_bone, 'Spine')
+
+
+def detect_structure(armature):
+    arma_structure = empty_arma_structure()
+    for _ in detect_structure_steps(armature, arma_structure):
+        pass
     return arma_structure
 
 
-class RET_OT_BuildBonesHierarchy(bpy.types.Operator):
+def constraint_snapshot(constr):
+    ''' return constraint type and its writable props, so it can be re-created later '''
+    props = {prop.identifier: getattr(constr, prop.identifier) for prop in constr.bl_rna.properties if not prop.is_readonly}
+    return constr.type, props
+
+
+def constraint_restore(constraints, constr_type, props, idx):
+    constr = constraints.new(constr_type)
+    for prop_name, value in props.items():
+        try:
+            setattr(constr, prop_name, value)
+        except (AttributeError, TypeError, ValueError):  # some props can't be set back (eg. depending on other props)
+            pass
+    constraints.move(len(constraints)-1, idx)
+    return constr
+
+
+def get_nla_range(arma):
+    ''' frame range of unmuted NLA strips (or active action) of arma, None if not animated '''
+    anim_data = arma.animation_data if arma else None
+    if not anim_data:
+        return None
+    strips = [strip for track in anim_data.nla_tracks if not track.mute for strip in track.strips if not strip.mute]
+    if strips:
+        return min(strip.frame_start for strip in strips), max(strip.frame_end for strip in strips)
+    if anim_data.action:
+        return tuple(anim_data.action.frame_range)
+    return None
+
+
+chains_evaluation_locked = False  # set while baking - chains stay unfrozen, so every frame is fully evaluated
+
+
+def retarget_constraints(p_bone):
+    ''' constraints on target rig bone, that follow empties '''
+    return [constr for constr in p_bone.constraints if constr.type in ['COPY_LOCATION', 'COPY_ROTATION'] and constr.target and constr.target.type == 'EMPTY']
+
+
+def store_frozen_state(bone_item, key, value):
+    ''' remember mute/hide state from before freeze - only first time, so re-freezing won't overwrite it '''
+    if key not in bone_item.frozen_states:
+        state = bone_item.frozen_states.add()
+        state.name = key
+        state.value = value
+
+
+def get_frozen_state(bone_item, key, default):
+    state = bone_item.frozen_states.get(key)
+    return state.value if state else default
+
+
+def set_target_bone_frozen(target_arma, bone_item, frozen):
+    ''' frozen bone keeps last evaluated pose, with its retarget constraints muted. Old matrix_basis and mute states are cached on bone_item '''
+    p_bone = target_arma.pose.bones.get(bone_item.name) if target_arma else None
+    if not p_bone:
+        return
+    constraints = retarget_constraints(p_bone)
+    if frozen and constraints and not bone_item.pose_cached:  # read pose before constraints get muted
+        bone_item.frozen_basis = [value for row in p_bone.matrix_basis for value in row]
+        bone_item.pose_cached = True
+        p_bone.matrix_basis = target_arma.convert_space(pose_bone=p_bone, matrix=p_bone.matrix, from_space='POSE', to_space='LOCAL')
+    elif not frozen and bone_item.pose_cached:
+        basis = bone_item.frozen_basis
+        p_bone.matrix_basis = Matrix((basis[0:4], basis[4:8], basis[8:12], basis[12:16]))
+        bone_item.pose_cached = False
+    for constr in constraints:
+        if frozen:
+            store_frozen_state(bone_item, constr.name, constr.mute)
+            constr.mute = True
+        else:
+            constr.mute = get_frozen_state(bone_item, constr.name, constr.mute)  # constraints added after freeze are left alone
+    if not frozen:
+        bone_item.frozen_states.clear()
+
+
+def set_src_bone_frozen(bone_item, frozen):
+    ''' mute and hide follower empties of source bone. Their old states are cached on bone_item '''
+    for empty in (bpy.data.objects.get(bone_item.name), bpy.data.objects.get(bone_item.name + 'T')):
+        if empty and empty.type == 'EMPTY':
+            for constr in empty.constraints:
+                key = f'{empty.name}/{constr.name}'
+                if frozen:
+                    store_frozen_state(bone_item, key, constr.mute)
+                    constr.mute = True
+                else:
+                    constr.mute = get_frozen_state(bone_item, key, constr.mute)
+            if frozen:
+                store_frozen_state(bone_item, empty.name, empty.hide_viewport)
+                empty.hide_viewport = True  # hidden objects are skipped by viewport depsgraph
+            else:
+                empty.hide_viewport = get_frozen_state(bone_item, empty.name, empty.hide_viewport)
+    if not frozen:
+        bone_item.frozen_states.clear()
+
+
+def set_chain_frozen(ret_props, bones_chain, frozen):
+    ''' frozen chain - target bones keep last evaluated pose, their retarget constraints and follower empties are muted '''
+    target_arma = bpy.data.objects.get(ret_props.target_armature)
+    for bone_item in bones_chain.target_bones:
+        set_target_bone_frozen(target_arma, bone_item, frozen)
+    for bone_item in bones_chain.src_bones:
+        set_src_bone_frozen(bone_item, frozen)
+    bones_chain.is_frozen = frozen
+
+
+def refresh_chains_evaluation(scene, force=False):
+    ''' freeze or unfreeze chains, whose state does not match performance mode settings. force - re-apply freeze to frozen chains (eg. for new constraints) '''
+    if chains_evaluation_locked:
+        return
+    ret_props = scene.retarget_settings
+    out_of_range = False
+    if ret_props.performance_mode and ret_props.auto_freeze:
+        nla_range = get_nla_range(bpy.data.objects.get(ret_props.src_armature))
+        out_of_range = nla_range is not None and not nla_range[0] <= scene.frame_current <= nla_range[1]
+    for bones_chain in ret_props.arma_hierarchy:
+        frozen = ret_props.performance_mode and (not bones_chain.live or out_of_range)
+        if frozen != bones_chain.is_frozen or (force and frozen):
+            set_chain_frozen(ret_props, bones_chain, frozen)
+
+
+def unfreeze_chains(ret_props):
+    ''' call before chains get removed, or muted constraints would stay muted '''
+    for bones_chain in ret_props.arma_hierarchy:
+        if bones_chain.is_frozen:
+            set_chain_frozen(ret_props, bones_chain, False)
+
+
+def update_chains_evaluation(self, context):
+    refresh_chains_evaluation(context.scene)
+
+
+@persistent
+def retarget_frame_change(scene, depsgraph=None):
+    ret_props = scene.retarget_settings
+    if ret_props.performance_mode and ret_props.auto_freeze:
+        refresh_chains_evaluation(scene)
+
+
+def hierarchy_to_dict(retarget_settings):
+    data = {
+        'src_armature': retarget_settings.src_armature,
+        'target_armature': retarget_settings.target_armature,
+        'arma_hierarchy': []
+    }
+
+    for hierarchy in retarget_settings.arma_hierarchy:
+        hierarchy_data = {
+            'name': hierarchy.name,
+            'live': hierarchy.live,
+            'src_bones': [],
+            'target_bones': [],
+            'src_bone_idx': hierarchy.src_bone_idx,
+            'target_bone_idx': hierarchy.target_bone_idx
+        }
+
+        for src_bone in hierarchy.src_bones:
+            hierarchy_data['src_bones'].append({
+                'name': src_bone.name,
+                'enabled': src_bone.enabled,
+                'copy_rot': src_bone.copy_rot,
+                'copy_loc': src_bone.copy_loc
+            })
+
+        for target_bone in hierarchy.target_bones:
+            hierarchy_data['target_bones'].append({
+                'name': target_bone.name,
+                'enabled': target_bone.enabled,
+                'copy_rot': target_bone.copy_rot,
+                'copy_loc': target_bone.copy_loc
+            })
+
+        data['arma_hierarchy'].append(hierarchy_data)
+    return data
+
+
+def hierarchy_from_dict(retarget_settings, data):
+    unfreeze_chains(retarget_settings)
+    retarget_settings.src_armature = data['src_armature']
+    retarget_settings.target_armature = data['target_armature']
+    retarget_settings.arma_hierarchy.clear()
+
+    for hierarchy_data in data['arma_hierarchy']:
+        hierarchy = retarget_settings.arma_hierarchy.add()
+        hierarchy.name = hierarchy_data['name']
+        hierarchy.src_bone_idx = hierarchy_data['src_bone_idx']
+        hierarchy.target_bone_idx = hierarchy_data['target_bone_idx']
+
+        for src_bone_data in hierarchy_data['src_bones']:
+            src_bone = hierarchy.src_bones.add()
+            src_bone.name = src_bone_data['name']
+            src_bone.enabled = src_bone_data['enabled']
+            src_bone.copy_rot = src_bone_data['copy_rot']
+            src_bone.copy_loc = src_bone_data['copy_loc']
+
+        for target_bone_data in hierarchy_data['target_bones']:
+            target_bone = hierarchy.target_bones.add()
+            target_bone.name = target_bone_data['name']
+            target_bone.enabled = target_bone_data['enabled']
+            target_bone.copy_rot = target_bone_data['copy_rot']
+            target_bone.copy_loc = target_bone_data['copy_loc']
+        hierarchy.live = hierarchy_data.get('live', True)  # after bones are added - update callback freezes them
+    refresh_chains_evaluation(retarget_settings.id_data)
+
+
+running_modal = None  # bl_label of TimeSlicedModal operator in progress - blocks other operators editing retarget data
+modal_interrupted = False  # set when undo runs while modal is in progress - its data references are then invalid
+
+
+def no_modal_running():
+    return running_modal is None
+
+
+@persistent
+def retarget_undo_pre(scene, *args):
+    global modal_interrupted
+    if running_modal:
+        modal_interrupted = True
+
+
+class TimeSlicedModal:
+    ''' Mixin for operators that run self.steps() generator in time-sliced chunks on a timer.
+    Operator has to implement: prepare(context) -> bool, steps(context) - generator that yields status text after each unit of work,
+    finish(context) and rollback(context) - called on Esc, so that operator leaves scene as it was '''
+    frame_budget = 1/30  # max seconds spent in one timer slice - keeps UI responsive
+    timer_step = 0.01
+
+    total = 1  # total number of steps - used for progress. Can be updated from steps()
+    done = 0
+    chunk_size = 1  # steps per slice - adapted in modal() to fit into frame_budget
+    _timer = None
+    _steps = None
+
+    @classmethod
+    def poll(cls, context):
+        return no_modal_running()
+
+    def prepare(self, context):
+        return True
+
+    def steps(self, context):
+        yield ''
+
+    def finish(self, context):
+        pass
+
+    def rollback(self, context):
+        pass
+
+    def execute(self, context):
+        ''' non interactive run (scripting, redo panel) - do all steps at once '''
+        if not self.prepare(context):
+            return {'CANCELLED'}
+        try:
+            for _ in self.steps(context):
+                pass
+            self.finish(context)
+        except Exception:
+            self.rollback(context)
+            raise
+        return {'FINISHED'}
+
+    def invoke(self, context, event):
+        global running_modal, modal_interrupted
+        if not no_modal_running():
+            self.report({'WARNING'}, f'Wait for {running_modal} to finish')
+            return {'CANCELLED'}
+        if not self.prepare(context):
+            return {'CANCELLED'}
+        running_modal = self.bl_label
+        modal_interrupted = False
+        self.done = 0
+        self.chunk_size = 1
+        self._steps = self.steps(context)
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(self.timer_step, window=context.window)
+        wm.progress_begin(0, 100)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if modal_interrupted:  # undo already reverted scene - nothing to roll back, and references are dead
+            self.end_modal(context)
+            self.report({'WARNING'}, f'{self.bl_label} interrupted by undo')
+            return {'CANCELLED'}
+        if event.type == 'ESC' and event.value == 'PRESS':
+            self.abort(context)
+            self.report({'INFO'}, f'{self.bl_label} cancelled')
+            return {'CANCELLED'}
+        if event.type in {'Z', 'Y'} and (event.ctrl or event.oskey):  # block undo/redo shortcuts while running
+            if event.value == 'PRESS':
+                self.report({'WARNING'}, f'Press Esc to cancel {self.bl_label} first')
+            return {'RUNNING_MODAL'}
+        if event.type != 'TIMER' or event.timer != self._timer:
+            return {'PASS_THROUGH'}
+
+        start = perf_counter()
+        status = ''
+        try:
+            for _ in range(self.chunk_size):
+                status = next(self._steps)
+                self.done += 1
+        except StopIteration:
+            try:
+                self.finish(context)
+            except Exception as e:
+                self.report({'ERROR'}, f'{self.bl_label} failed: {e}')
+                self.abort(context)
+                return {'CANCELLED'}
+            self.end_modal(context)
+            return {'FINISHED'}
+        except Exception as e:
+            self.report({'ERROR'}, f'{self.bl_label} failed: {e}')
+            self.abort(context)
+            return {'CANCELLED'}
+
+        # grow or shrink chunk, so that one slice stays under frame_budget
+        elapsed = perf_counter() - start
+        if elapsed < self.frame_budget/2:
+            self.chunk_size *= 2
+        elif elapsed > self.frame_budget:
+            self.chunk_size = max(1, self.chunk_size//2)
+
+        progress = min(100, int(100*self.done/max(1, self.total)))
+        context.window_manager.progress_update(progress)
+        if context.workspace:
+            context.workspace.status_text_set(f'{self.bl_label}: {progress}% {status}  (Esc to cancel)')
+        return {'RUNNING_MODAL'}
+
+    def abort(self, context):
+        ''' Esc or error - stop and leave scene as it was before operator run '''
+        self.end_modal(context)
+        try:
+            self.rollback(context)
+        except Exception as e:  # data may be already gone
+            self.report({'ERROR'}, f'{self.bl_label} rollback failed: {e}')
+
+    def cancel(self, context):
+        ''' called by blender when modal gets torn down (file load, window close) - data may be freed, so no rollback '''
+        self.end_modal(context)
+
+    def end_modal(self, context):
+        global running_modal, modal_interrupted, chains_evaluation_locked
+        running_modal = None
+        modal_interrupted = False
+        chains_evaluation_locked = False
+        wm = context.window_manager
+        if self._timer:
+            wm.event_timer_remove(self._timer)
+            self._timer = None
+        wm.progress_end()
+        if context.workspace:
+            context.workspace.status_text_set(None)
+        self._steps = None
+
+
+def get_rigs(operator, ret_props):
+    ''' return source and target armature objects, or None, None if any of them is missing '''
+    source_arma = bpy.data.objects.get(ret_props.src_armature)
+    target_arma = bpy.data.objects.get(ret_props.target_armature)
+    if not source_arma or not target_arma:
+        operator.report({'WARNING'}, 'Pick source and target rig first')
+        return None, None
+    return source_arma, target_arma
+
+
+class RET_OT_BuildBonesHierarchy(TimeSlicedModal, bpy.types.Operator):
     bl_idname = "object.build_bones_hierarchy"
     bl_label = "Build Bones Hierarchy"
     bl_description = "Build Bones Hierarchy"
     bl_options = {"REGISTER","UNDO"}
 
-    def execute(self, context):
+    def prepare(self, context):
+        ret_props = context.scene.retarget_settings
+        self.source_arma, self.target_arma = get_rigs(self, ret_props)
+        if not self.source_arma:
+            return False
+        self.old_hierarchy = hierarchy_to_dict(ret_props)  # for rollback on Esc
+        # scans visit at most all bones of both rigs, + default chains count. Updated after scan
+        self.total = len(self.source_arma.data.bones) + len(self.target_arma.data.bones) + 7
+        return True
+
+    def steps(self, context):
         ret_props = context.scene.retarget_settings
-        source_arma = bpy.data.objects[ret_props.src_armature]
-        target_arma = bpy.data.objects[ret_props.target_armature]
-        src_chain_root_bones = detect_structure(source_arma)  # will containt chain_id: bone.name
-        target_chain_root_bones = detect_structure(target_arma)
+        src_chain_root_bones = empty_arma_structure()  # will containt chain_id: bone.name
+        for bone_name in detect_structure_steps(self.source_arma, src_chain_root_bones):
+            yield f'source {bone_name}'
+        target_chain_root_bones = empty_arma_structure()
+        for bone_name in detect_structure_steps(self.target_arma, target_chain_root_bones):
+            yield f'target {bone_name}'
+        self.total = self.done + len(src_chain_root_bones)
 
         #copy dict to CollectionProperty - ArmaHierarchyStructures
+        unfreeze_chains(ret_props)
         ret_props.arma_hierarchy.clear()
         for chain_key in src_chain_root_bones.keys():
             current_hierarchy = ret_props.arma_hierarchy.add()
@@ -199,11 +595,16 @@ class RET_OT_BuildBonesHierarchy(bpy.types.Operator):
                 for bone in target_bone_chain:
                     new_bone = current_hierarchy.target_bones.add()
                     new_bone.name = bone.name
+            yield chain_key
 
-        return {"FINISHED"}
+    def finish(self, context):
+        refresh_chains_evaluation(context.scene)
+
+    def rollback(self, context):
+        hierarchy_from_dict(context.scene.retarget_settings, self.old_hierarchy)
 
 
-class RET_OT_CleanConstraintsHierarchy(bpy.types.Operator):
+class RET_OT_CleanConstraintsHierarchy(TimeSlicedModal, bpy.types.Operator):
     bl_idname = "object.clean_constraints"
     bl_label = "Clean Constraints"
     bl_description = "Clean Constraints"
@@ -211,22 +612,34 @@ class RET_OT_CleanConstraintsHierarchy(bpy.types.Operator):
 
     @classmethod
     def poll(cls, context):
-        return context.active_object and context.active_object.type == 'ARMATURE'
+        return no_modal_running() and context.active_object and context.active_object.type == 'ARMATURE'
 
-    def execute(self, context):
+    def prepare(self, context):
+        self.arma = context.active_object  # active object may change while modal runs
+        self.removed = []  # (bone name, constr idx, constr type, constr props) - for rollback
+        self.total = len(self.arma.pose.bones)
+        return True
+
+    def steps(self, context):
         # get all copy raotation locatoin constraints that target empties and remove them
-        for p_bone in context.active_object.pose.bones:
-            for constr in reversed(p_bone.constraints):
+        for p_bone in self.arma.pose.bones:
+            for idx in reversed(range(len(p_bone.constraints))):
+                constr = p_bone.constraints[idx]
                 if constr.type in ['COPY_LOCATION', 'COPY_ROTATION']:
                     if constr.target and constr.target.type == 'EMPTY':
+                        self.removed.append((p_bone.name, idx, *constraint_snapshot(constr)))
                         p_bone.constraints.remove(constr)
+            yield p_bone.name
 
+    def finish(self, context):
         self.report({'INFO'}, 'Cleanup sucesfull')
 
-        return {"FINISHED"}
+    def rollback(self, context):
+        for bone_name, idx, constr_type, props in reversed(self.removed):
+            constraint_restore(self.arma.pose.bones[bone_name].constraints, constr_type, props, idx)
 
 
-class RET_OT_RetargetByEmpties(bpy.types.Operator):
+class RET_OT_RetargetByEmpties(TimeSlicedModal, bpy.types.Operator):
     bl_idname = "object.retarget_using_empties"
     bl_label = "Retarget using empties"
     bl_description = "Add copy rotation (and location) constraints to target rig, so that they will follow empties from source rig"
@@ -248,6 +661,7 @@ class RET_OT_RetargetByEmpties(bpy.types.Operator):
                     return
             constr = target_bone.constraints.new('COPY_ROTATION')
             constr.name = 'RetargetRot'
+            self.new_constraints.append((target_bone.id_data, target_bone.name, constr.name))
 
             constr.target = target_empty
         if copy_loc:
@@ -256,23 +670,44 @@ class RET_OT_RetargetByEmpties(bpy.types.Operator):
                     return
             constr = target_bone.constraints.new('COPY_LOCATION')
             constr.name = 'RetargetLoc'
+            self.new_constraints.append((target_bone.id_data, target_bone.name, constr.name))
 
             constr.target = target_empty
 
-    def execute(self, context):
+    def prepare(self, context):
+        ret_props = context.scene.retarget_settings
+        self.source_arma, self.target_arma = get_rigs(self, ret_props)
+        if not self.source_arma:
+            return False
+        # what was added or changed - so Esc can undo it
+        self.new_collections = []
+        self.new_objects = []
+        self.new_links = []  # (collection, obj)
+        self.old_parents = []  # (obj, old parent)
+        self.new_constraints = []  # (obj, bone name or None, constraint name)
+
+        self.total = sum(len(chain.src_bones) for chain in ret_props.arma_hierarchy)
+        for bones_chain in ret_props.arma_hierarchy:
+            if len(bones_chain.src_bones) and len(bones_chain.target_bones):
+                self.total += min(len([b for b in bones_chain.src_bones if b.enabled]), len([b for b in bones_chain.target_bones if b.enabled]))
+        return True
+
+    def steps(self, context):
         ret_props = context.scene.retarget_settings
-        source_arma = bpy.data.objects[ret_props.src_armature]
-        target_arma = bpy.data.objects[ret_props.target_armature]
+        source_arma = self.source_arma
+        target_arma = self.target_arma
 
         if 'BoneFollowers' not in bpy.data.collections.keys():
             bone_follow_coll = bpy.data.collections.new('BoneFollowers')
             context.scene.collection.children.link(bone_follow_coll)
+            self.new_collections.append(bone_follow_coll)
         else:
             bone_follow_coll = bpy.data.collections['BoneFollowers']
 
         if 'Targets' not in bpy.data.collections.keys():
             bone_target_coll = bpy.data.collections.new('Targets')
             context.scene.collection.children.link(bone_target_coll)
+            self.new_collections.append(bone_target_coll)
         else:
             bone_target_coll = bpy.data.collections['Targets']
 
@@ -287,18 +722,21 @@ class RET_OT_RetargetByEmpties(bpy.types.Operator):
                     empty_box.empty_display_size = sqrt(edit_bone.length)/40
                     empty_box.empty_display_type = 'CUBE'
                     bone_follow_coll.objects.link(empty_box)
+                    self.new_objects.append(empty_box)
 
                 old_rot_contr = [constr for constr in empty_box.constraints if constr.type == 'COPY_ROTATION' and constr.target == source_arma and constr.subtarget == edit_bone.name]
                 if not old_rot_contr:
                     copy_rot = empty_box.constraints.new('COPY_ROTATION')
                     copy_rot.target = source_arma
                     copy_rot.subtarget = edit_bone.name
+                    self.new_constraints.append((empty_box, None, copy_rot.name))
 
                 old_loc_contr = [constr for constr in empty_box.constraints if constr.type == 'COPY_LOCATION' and constr.target == source_arma and constr.subtarget == edit_bone.name]
                 if not old_loc_contr:
                     copy_loc = empty_box.constraints.new('COPY_LOCATION')
                     copy_loc.target = source_arma
                     copy_loc.subtarget = edit_bone.name
+                    self.new_constraints.append((empty_box, None, copy_loc.name))
 
                 object_name = edit_bone.name + 'T'
                 empty_child = bpy.data.objects.get(object_name)
@@ -306,10 +744,15 @@ class RET_OT_RetargetByEmpties(bpy.types.Operator):
                     empty_child = bpy.data.objects.new(object_name, None)
                     empty_child.empty_display_size = sqrt(edit_bone.length)/40
                     empty_child.empty_display_type = 'SPHERE'
+                    self.new_objects.append(empty_child)
 
                 if empty_child.name not in bone_target_coll.objects.keys():
                     bone_target_coll.objects.link(empty_child)
-                empty_child.parent = empty_box
+                    self.new_links.append((bone_target_coll, empty_child))
+                if empty_child.parent != empty_box:
+                    self.old_parents.append((empty_child, empty_child.parent))
+                    empty_child.parent = empty_box
+                yield edit_bone.name
 
 
         for bones_chain in ret_props.arma_hierarchy:
@@ -326,8 +769,112 @@ class RET_OT_RetargetByEmpties(bpy.types.Operator):
                 # t_bone = target_arma.data.bones[target_bone.name]
                 #* set constraints on target armature bones to copy loc, rot - from target empties
                 self.setup_constraints(context, source_arma.pose.bones[src_bone.name], target_arma.pose.bones[target_bone.name], target_bone.copy_loc, target_bone.copy_rot)  # first for chain roots
+                yield target_bone.name
+
+    def finish(self, context):
+        refresh_chains_evaluation(context.scene, force=True)  # mute new constraints on frozen chains
+
+    def rollback(self, context):
+        for obj, bone_name, constr_name in reversed(self.new_constraints):
+            constraints = obj.pose.bones[bone_name].constraints if bone_name else obj.constraints
+            if constr_name in constraints:
+                constraints.remove(constraints[constr_name])
+        for obj, old_parent in reversed(self.old_parents):
+            obj.parent = old_parent
+        for coll, obj in self.new_links:
+            coll.objects.unlink(obj)
+        for obj in self.new_objects:
+            bpy.data.objects.remove(obj)
+        for coll in self.new_collections:
+            bpy.data.collections.remove(coll)
+
+
+class RET_OT_BakeRetarget(TimeSlicedModal, bpy.types.Operator):
+    bl_idname = "object.bake_retarget"
+    bl_label = "Bake Retarget"
+    bl_description = "Bake retargeted pose of target rig chain bones into new action, over scene frame range"
+    bl_options = {"REGISTER","UNDO"}
 
-        return {"FINISHED"}
+    def prepare(self, context):
+        global chains_evaluation_locked
+        ret_props = context.scene.retarget_settings
+        self.target_arma = bpy.data.objects.get(ret_props.target_armature)
+        if not self.target_arma:
+            self.report({'WARNING'}, 'Pick target rig first')
+            return False
+        pose_bones = self.target_arma.pose.bones
+        self.bone_names = list(dict.fromkeys(b.name for chain in ret_props.arma_hierarchy for b in chain.target_bones if b.enabled and b.name in pose_bones))
+        if not self.bone_names:
+            self.report({'WARNING'}, 'No target bones to bake')
+            return False
+        scene = context.scene
+        self.frames = range(scene.frame_start, scene.frame_end + 1)
+        self.org_frame = scene.frame_current
+        self.baked = {name: [] for name in self.bone_names}  # bone name: local matrix per frame. Written to action in finish()
+        self.total = len(self.frames)
+
+        # frozen chains would bake their pinned pose - unfreeze all, and keep frame handler from freezing them mid bake
+        unfreeze_chains(ret_props)
+        chains_evaluation_locked = True
+        return True
+
+    def steps(self, context):
+        for frame in self.frames:
+            context.scene.frame_set(frame)
+            for name in self.bone_names:
+                p_bone = self.target_arma.pose.bones[name]
+                self.baked[name].append(self.target_arma.convert_space(pose_bone=p_bone, matrix=p_bone.matrix, from_space='POSE', to_space='LOCAL'))
+            yield f'frame {frame}'
+
+    def finish(self, context):
+        context.scene.frame_set(self.org_frame)
+        action = bpy.data.actions.new(self.target_arma.name + 'Baked')
+        for name, matrices in self.baked.items():
+            p_bone = self.target_arma.pose.bones[name]
+            rot_path = {'QUATERNION': 'rotation_quaternion', 'AXIS_ANGLE': 'rotation_axis_angle'}.get(p_bone.rotation_mode, 'rotation_euler')
+            channels = {'location': [], rot_path: [], 'scale': []}
+            prev_rot = None
+            for mat in matrices:
+                loc, rot, scale = mat.decompose()
+                if p_bone.rotation_mode == 'QUATERNION':
+                    if prev_rot is not None:
+                        rot.make_compatible(prev_rot)  # avoid flips between frames
+                    prev_rot = rot
+                elif p_bone.rotation_mode == 'AXIS_ANGLE':
+                    axis, angle = rot.to_axis_angle()
+                    rot = (angle, *axis)
+                else:
+                    rot = rot.to_euler(p_bone.rotation_mode, prev_rot) if prev_rot is not None else rot.to_euler(p_bone.rotation_mode)
+                    prev_rot = rot
+                channels['location'].append(tuple(loc))
+                channels[rot_path].append(tuple(rot))
+                channels['scale'].append(tuple(scale))
+
+            for prop_name, values in channels.items():
+                for axis in range(len(values[0])):
+                    fcurve = action.fcurves.new(p_bone.path_from_id(prop_name), index=axis, action_group=name)
+                    fcurve.keyframe_points.add(len(values))
+                    fcurve.keyframe_points.foreach_set('co', [co for frame, value in zip(self.frames, values) for co in (frame, value[axis])])
+                    fcurve.update()
+
+        anim_data = self.target_arma.animation_data or self.target_arma.animation_data_create()
+        old_action = anim_data.action
+        anim_data.action = action
+        if old_action:
+            old_action.use_fake_user = True  # keep replaced action on file save
+            self.report({'INFO'}, f'Baked {len(self.frames)} frames to {action.name}. Replaced action {old_action.name} was kept with fake user')
+        else:
+            self.report({'INFO'}, f'Baked {len(self.frames)} frames to {action.name}')
+        self.unlock_chains_evaluation(context)
+
+    def rollback(self, context):
+        context.scene.frame_set(self.org_frame)
+        self.unlock_chains_evaluation(context)
+
+    def unlock_chains_evaluation(self, context):
+        global chains_evaluation_locked
+        chains_evaluation_locked = False
+        refresh_chains_evaluation(context.scene)  # freeze back chains, as performance mode settings say
 
 
 class ARMATURE_UL_target_chains_list(bpy.types.UIList):
@@ -356,6 +903,22 @@ class ARMATURE_UL_target_chains_list(bpy.types.UIList):
             layout.label(text="")
 
 
+class ARMATURE_UL_hierarchy_list(bpy.types.UIList):
+    def draw_item(self, context, layout, data, item, icon, active_data, active_propname):
+        bones_chain = item
+        if self.layout_type in {'DEFAULT', 'COMPACT'}:
+            if bones_chain:
+                row = layout.row(align=True)
+                row.prop(bones_chain, 'name', emboss=False, text='')
+                ic = 'FREEZE' if bones_chain.is_frozen else 'PLAY'
+                row.prop(bones_chain, 'live', emboss=False, icon=ic, icon_only=True)
+            else:
+                layout.label(text="", translate=False)
+        elif self.layout_type in {'GRID'}:
+            layout.alignment = 'CENTER'
+            layout.label(text="")
+
+
 class ARMATURE_UL_src_chains_list(bpy.types.UIList):
     def draw_item(self, context, layout, data, item, icon, active_data, active_propname):
         hierarchy_structure = data
@@ -394,8 +957,14 @@ class ARMATURE_PT_BonesHierarchy(bpy.types.Panel):
 
         layout.operator('object.build_bones_hierarchy')
 
+        row = layout.row(align=True)
+        row.prop(ret_props, 'performance_mode', toggle=True)
+        sub_row = row.row(align=True)
+        sub_row.active = ret_props.performance_mode
+        sub_row.prop(ret_props, 'auto_freeze', toggle=True)
+
         row = layout.row()
-        row.template_list("UI_UL_list", "name", ret_props, "arma_hierarchy", ret_props, "hierarchy_idx")
+        row.template_list("ARMATURE_UL_hierarchy_list", "", ret_props, "arma_hierarchy", ret_props, "hierarchy_idx")
         col = row.column(align=True)
         col.operator("object.add_chain", icon='ADD', text="")
         col.operator("object.remove_chain", icon='REMOVE', text="")
@@ -422,6 +991,7 @@ class ARMATURE_PT_BonesHierarchy(bpy.types.Panel):
 
         layout.operator('object.clean_constraints')
         layout.operator('object.retarget_using_empties')
+        layout.operator('object.bake_retarget')
 
         # save and raad json opers
         col = layout.column(align=True)
@@ -452,42 +1022,7 @@ class RET_OT_WriteChain(bpy.types.Operator):
 
     @staticmethod
     def json_write(filepath):
-        scene = bpy.context.scene
-        retarget_settings = scene.retarget_settings
-
-        data = {
-            'src_armature': retarget_settings.src_armature,
-            'target_armature': retarget_settings.target_armature,
-            'arma_hierarchy': []
-        }
-
-        for hierarchy in retarget_settings.arma_hierarchy:
-            hierarchy_data = {
-                'name': hierarchy.name,
-                'src_bones': [],
-                'target_bones': [],
-                'src_bone_idx': hierarchy.src_bone_idx,
-                'target_bone_idx': hierarchy.target_bone_idx
-            }
-
-            for src_bone in hierarchy.src_bones:
-                hierarchy_data['src_bones'].append({
-                    'name': src_bone.name,
-                    'enabled': src_bone.enabled,
-                    'copy_rot': src_bone.copy_rot,
-                    'copy_loc': src_bone.copy_loc
-                })
-
-            for target_bone in hierarchy.target_bones:
-                hierarchy_data['target_bones'].append({
-                    'name': target_bone.name,
-                    'enabled': target_bone.enabled,
-                    'copy_rot': target_bone.copy_rot,
-                    'copy_loc': target_bone.copy_loc
-                })
-
-            data['arma_hierarchy'].append(hierarchy_data)
-
+        data = hierarchy_to_dict(bpy.context.scene.retarget_settings)
         with open(filepath, 'w') as f:
             json.dump(data, f, indent=4)
 
@@ -501,6 +1036,10 @@ class RET_OT_ReadChain(bpy.types.Operator):
 
     filepath: bpy.props.StringProperty(subtype="FILE_PATH")
 
+    @classmethod
+    def poll(cls, context):
+        return no_modal_running()
+
     def execute(self, context):
         self.report({'INFO'}, "Selected file: " + self.filepath)
         self.json_read(self.filepath)
@@ -513,37 +1052,16 @@ class RET_OT_ReadChain(bpy.types.Operator):
 
     @staticmethod
     def json_read(filepath):
-        scene = bpy.context.scene
-        retarget_settings = scene.retarget_settings
-
         with open(filepath, 'r') as f:
             data = json.load(f)
+        hierarchy_from_dict(bpy.context.scene.retarget_settings, data)
 
-        retarget_settings.src_armature = data['src_armature']
-        retarget_settings.target_armature = data['target_armature']
-        retarget_settings.arma_hierarchy.clear()
 
-        for hierarchy_data in data['arma_hierarchy']:
-            hierarchy = retarget_settings.arma_hierarchy.add()
-            hierarchy.name = hierarchy_data['name']
-            hierarchy.src_bone_idx = hierarchy_data['src_bone_idx']
-            hierarchy.target_bone_idx = hierarchy_data['target_bone_idx']
-
-            for src_bone_data in hierarchy_data['src_bones']:
-                src_bone = hierarchy.src_bones.add()
-                src_bone.name = src_bone_data['name']
-                src_bone.enabled = src_bone_data['enabled']
-                src_bone.copy_rot = src_bone_data['copy_rot']
-                src_bone.copy_loc = src_bone_data['copy_loc']
-
-            for target_bone_data in hierarchy_data['target_bones']:
-                target_bone = hierarchy.target_bones.add()
-                target_bone.name = target_bone_data['name']
-                target_bone.enabled = target_bone_data['enabled']
-                target_bone.copy_rot = target_bone_data['copy_rot']
-                target_bone.copy_loc = target_bone_data['copy_loc']
 
 
+class FrozenState(bpy.types.PropertyGroup):
+    name: bpy.props.StringProperty()  # constraint name, 'empty/constraint' name, or empty name for its hide_viewport
+    value: bpy.props.BoolProperty()
 
 
 class ChainBones(bpy.types.PropertyGroup):
@@ -551,6 +1069,9 @@ class ChainBones(bpy.types.PropertyGroup):
     enabled: bpy.props.BoolProperty(name='Enabled', description='', default=True)
     copy_rot: bpy.props.BoolProperty(name='Copy Rot', description='', default=True)
     copy_loc: bpy.props.BoolProperty(name='Copy Loc', description='', default=False)
+    pose_cached: bpy.props.BoolProperty(name='Pose Cached', description='Bone is frozen and its original pose is stored in frozen_basis', default=False)
+    frozen_basis: bpy.props.FloatVectorProperty(name='Frozen Basis', description='Bone matrix_basis (row major) from before chain got frozen', size=16)
+    frozen_states: bpy.props.CollectionProperty(type=FrozenState)  # mute and hide states from before chain got frozen
 
 
 class RET_OT_AddChainBone(bpy.types.Operator):
@@ -562,6 +1083,10 @@ class RET_OT_AddChainBone(bpy.types.Operator):
     do_src: bpy.props.BoolProperty(name='Source bones?', default=True)
     name: bpy.props.StringProperty(name='Name', description='', default='Bone')
 
+    @classmethod
+    def poll(cls, context):
+        return no_modal_running()
+
     def invoke(self, context, event):
         return context.window_manager.invoke_props_dialog(self)
 
@@ -584,6 +1109,11 @@ class RET_OT_AddChainBone(bpy.types.Operator):
             else:
                 new_bone = hierarchy.target_bones.add()
             new_bone.name = self.name
+            if hierarchy.is_frozen:  # keep whole chain frozen
+                if self.do_src:
+                    set_src_bone_frozen(new_bone, True)
+                else:
+                    set_target_bone_frozen(bpy.data.objects.get(ret_props.target_armature), new_bone, True)
         else:
             self.report({'WARNING'}, 'Provide bone name')
 
@@ -598,12 +1128,20 @@ class RET_OT_RemoveChainBone(bpy.types.Operator):
 
     do_src: bpy.props.BoolProperty(name='Source bones?', default=True)
 
+    @classmethod
+    def poll(cls, context):
+        return no_modal_running()
+
     def execute(self, context):
         ret_props = context.scene.retarget_settings
         hierarchy = ret_props.arma_hierarchy[ret_props.hierarchy_idx]
         if self.do_src:
+            if hierarchy.is_frozen and hierarchy.src_bone_idx < len(hierarchy.src_bones):  # or its empties stay muted
+                set_src_bone_frozen(hierarchy.src_bones[hierarchy.src_bone_idx], False)
             hierarchy.src_bones.remove(hierarchy.src_bone_idx)
         else:
+            if hierarchy.is_frozen and hierarchy.target_bone_idx < len(hierarchy.target_bones):  # or its constraints stay muted
+                set_target_bone_frozen(bpy.data.objects.get(ret_props.target_armature), hierarchy.target_bones[hierarchy.target_bone_idx], False)
             hierarchy.target_bones.remove(hierarchy.target_bone_idx)
         return {"FINISHED"}
 
@@ -617,6 +1155,9 @@ class ArmaHierarchyStructures(bpy.types.PropertyGroup):
     target_bones: bpy.props.CollectionProperty(type=ChainBones)
     src_bone_idx: bpy.props.IntProperty(name='Active Hierarchy Idx', description='', default= 1, min=0, max=100)
 
+    live: bpy.props.BoolProperty(name='Live', description='Evaluate chain retarget constraints and empties. When disabled in Performance Mode, chain is frozen in its last pose', default=True, update=update_chains_evaluation)
+    is_frozen: bpy.props.BoolProperty(name='Frozen', description='Frozen state currently applied to the scene', default=False)
+
 
 class RET_OT_AddChain(bpy.types.Operator):
     bl_idname = "object.add_chain"
@@ -624,6 +1165,10 @@ class RET_OT_AddChain(bpy.types.Operator):
     bl_description = "Add Chain"
     bl_options = {"REGISTER", "UNDO"}
 
+    @classmethod
+    def poll(cls, context):
+        return no_modal_running()
+
     def execute(self, context):
         chain = context.scene.retarget_settings.arma_hierarchy.add()
         return {"FINISHED"}
@@ -634,8 +1179,14 @@ class RET_OT_RemoveChain(bpy.types.Operator):
     bl_description = "Remove Chain"
     bl_options = {"REGISTER", "UNDO"}
 
+    @classmethod
+    def poll(cls, context):
+        return no_modal_running()
+
     def execute(self, context):
         ret_props = context.scene.retarget_settings
+        if ret_props.hierarchy_idx < len(ret_props.arma_hierarchy) and ret_props.arma_hierarchy[ret_props.hierarchy_idx].is_frozen:
+            set_chain_frozen(ret_props, ret_props.arma_hierarchy[ret_props.hierarchy_idx], False)
         ret_props.arma_hierarchy.remove(ret_props.hierarchy_idx)
         return {"FINISHED"}
 
@@ -644,14 +1195,18 @@ class RetargetingSettings(bpy.types.PropertyGroup):
     target_armature: bpy.props.StringProperty(name='Target Rig')
     arma_hierarchy: bpy.props.CollectionProperty(type=ArmaHierarchyStructures)
     hierarchy_idx: bpy.props.IntProperty(name='Active Hierarchy Idx', description='', default= 1, min=0, max=100)
+    performance_mode: bpy.props.BoolProperty(name='Performance Mode', description='Freeze chains that are not Live, to speed up playback', default=False, update=update_chains_evaluation)
+    auto_freeze: bpy.props.BoolProperty(name='Freeze Outside NLA', description='In Performance Mode freeze all chains when current frame is outside of source rig NLA range', default=False, update=update_chains_evaluation)
 
 
 classes = (
     RET_OT_RetargetByEmpties,
     RET_OT_BuildBonesHierarchy,
     RET_OT_CleanConstraintsHierarchy,
+    RET_OT_BakeRetarget,
     RET_OT_WriteChain,
     RET_OT_ReadChain,
+    FrozenState,
     ChainBones,
     ArmaHierarchyStructures,
     RetargetingSettings,
@@ -662,6 +1217,7 @@ classes = (
     ARMATURE_PT_BonesHierarchy,
     ARMATURE_UL_src_chains_list,
     ARMATURE_UL_target_chains_list,
+    ARMATURE_UL_hierarchy_list,
 )
 
 def register():
@@ -670,8 +1226,17 @@ def register():
         register_class(cls)
 
     bpy.types.Scene.retarget_settings = bpy.props.PointerProperty(type=RetargetingSettings)
+    bpy.app.handlers.frame_change_pre.append(retarget_frame_change)
+    bpy.app.handlers.undo_pre.append(retarget_undo_pre)
+    bpy.app.handlers.redo_pre.append(retarget_undo_pre)
 
 def unregister():
+    if retarget_undo_pre in bpy.app.handlers.undo_pre:
+        bpy.app.handlers.undo_pre.remove(retarget_undo_pre)
+    if retarget_undo_pre in bpy.app.handlers.redo_pre:
+        bpy.app.handlers.redo_pre.remove(retarget_undo_pre)
+    if retarget_frame_change in bpy.app.handlers.frame_change_pre:
+        bpy.app.handlers.frame_change_pre.remove(retarget_frame_change)
     from bpy.utils import unregister_class
     for cls in reversed(classes):
         unregister_class(cls)